@@ -1,27 +1,33 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import io
-import json
+import os
 import pathlib
 import re
-import urllib.parse
-import urllib.request
-from typing import TypedDict, Literal, Optional, List, Union, NoReturn, TextIO, Tuple
+import shutil
+import subprocess
+import time
+from typing import (TypedDict, Literal, Optional, List, Union, NoReturn, TextIO, Tuple, Callable, Any, Dict, Iterator,
+                    Set, TYPE_CHECKING)
 
 import click
-import git
-import jsonschema
-import rich.console
-import rich.progress
-import rich.traceback
-
-rich.traceback.install(show_locals=False)
-
-git_folder_pattern = re.compile(r"([a-zA-Z1-9_-]+)")
+import orjson
 
+# Rich and requests take a noticeable time to import, they are only imported by the commands using them
+if TYPE_CHECKING:
+    import requests
+    import rich.console
+    import rich.progress
 
 # TODO: better schema validation
 # https://stackoverflow.com/questions/38717933/jsonschema-attribute-conditionally-required
 
 
+@functools.lru_cache(maxsize=None)
 def git_folder_name(url: str):
     """
     Return the last part on an url without the extention
@@ -36,9 +42,30 @@ def git_folder_name(url: str):
 
     >>> git_folder_name("https://git.minetest.land/MineClone2/MineClone2/")
     'MineClone2'
+
+    >>> git_folder_name("https://github.com/a/my.mod")
+    'my'
+
+    >>> git_folder_name("https://h/a/b?x")
+    'b'
+
+    >>> git_folder_name("https://h/a/b.git#readme")
+    'b'
     """
-    url_parts = urllib.parse.urlparse(url)
-    return url_parts.path.rstrip("/").rpartition("/")[2].rsplit('.', 1)[0]
+    # Same result as the path of urllib.parse.urlparse, without building the whole parse result
+    path = url.partition("#")[0].partition("?")[0]
+    tail = path.rstrip("/").rpartition("/")[2].partition(";")[0]
+    return tail.rsplit(".", 1)[0]
+
+
+# Characters allowed in the name of a package folder
+folder_name_pattern = re.compile(r"[A-Za-z0-9_-]+")
+
+
+# A "/packages/<author>/<name>" path at the end of the URL, optionally followed by a query or a fragment
+# Unlike splitting the path of urllib.parse.urlparse, the scheme and host aren't checked (a prefix before "/packages" is
+# accepted), ";params" are kept in the name, and an empty author or a path without leading slash are rejected
+cdb_url_pattern = re.compile(r"/packages/([^/?#]+)/([^/?#]+)/*(?:[?#].*)?$")
 
 
 def cdb_package_infos(url: str) -> Optional[Tuple[str, str]]:
@@ -50,17 +77,28 @@ def cdb_package_infos(url: str) -> Optional[Tuple[str, str]]:
 
     >>> cdb_package_infos("https://content.minetest.net/packages/davidthecreator/rangedweapons/")
     ('davidthecreator', 'rangedweapons')
+
+    >>> cdb_package_infos("https://content.minetest.net/packages/AFCM/subway_miner/?protocol_version=42")
+    ('AFCM', 'subway_miner')
+
+    >>> cdb_package_infos("https://content.minetest.net/packages/AFCM/subway_miner#reviews")
+    ('AFCM', 'subway_miner')
+
+    >>> cdb_package_infos("/packages/AFCM/subway_miner")
+    ('AFCM', 'subway_miner')
+
+    >>> cdb_package_infos("https://content.minetest.net/packages/AFCM/subway_miner/releases/") is None
+    True
     """
-    url_parts = urllib.parse.urlparse(url)
-    url_path = url_parts.path.strip("/")
-    url_path_parts = url_path.split("/")
-    if len(url_path_parts) != 3 or url_path_parts[0] != "packages":
+    match = cdb_url_pattern.search(url)
+    if not match:
         return None
-    return url_path_parts[1], url_path_parts[2]
+    return match[1], match[2]
 
 
 PackageCategory = Literal["mods", "client_mods", "games", "texture_packs"]
 PackageType = Literal["git", "cdb"]
+CloneStrategy = Literal["full", "shallow", "blobless", "treeless"]
 
 
 class ConfigPackage(TypedDict):
@@ -71,6 +109,7 @@ class ConfigPackage(TypedDict):
     url: str
     folder_name: Optional[str]
     git_remote_branch: Optional[str]
+    clone_strategy: Optional[CloneStrategy]
 
 
 class ConfigContent(TypedDict):
@@ -83,6 +122,17 @@ class Config(TypedDict):
     auto_sort: Optional[bool]
 
 
+PACKAGE_CATEGORIES: Tuple[PackageCategory, ...] = ("mods", "client_mods", "games", "texture_packs")
+
+
+class ConfigIndex(TypedDict):
+    """
+    URLs and folder names of the packages of each category
+    """
+    urls: Dict[PackageCategory, Set[str]]
+    folder_names: Dict[PackageCategory, Set[str]]
+
+
 class CDBPackage(TypedDict):
     author: str
     name: str
@@ -96,88 +146,349 @@ class CDBPackage(TypedDict):
 ASSUMED_REMOTE_NAME = "origin"
 
 
-def update_package_git_repo(package: ConfigPackage, collection_folder: pathlib.Path, console: rich.console.Console):
-    # Get the name of the folder where the package will be stored
-    package_folder_name = package.get("folder_name") or git_folder_name(package["url"])
+def package_folder_name(package: ConfigPackage) -> str:
+    """
+    Return the name of the folder where the package is stored
+    """
+    return package.get("folder_name") or git_folder_name(package["url"])
+
+
+# Log message prefixes and their style, package logs are assembled from them without any markup parsing
+CLONED_STATUS = ("Cloned ", "green")
+UPDATED_STATUS = ("Updated ", "green")
+SKIPPED_STATUS = ("Skipped ", "dim")
+CANT_UPDATE_STATUS = ("Can't update ", "red")
+KEEPING_CHANGES_STATUS = ("Keeping local changes of ", "yellow")
+
+
+def log_package_status(console: rich.console.Console, status: Tuple[str, str], package: ConfigPackage,
+                       details: str = ""):
+    """
+    Log the status of a package, the URL and details are displayed as is (no markup nor highlighting)
+    """
+    import rich.text
+
+    console.log(rich.text.Text.assemble(status, (package["url"], "blue"), (details, status[1])), highlight=False,
+                _stack_offset=2)
 
-    # Get path of package folder
-    package_folder = collection_folder / package_folder_name
 
-    # Check if the
+def index_config(config: Config) -> ConfigIndex:
+    """
+    Index the packages of every category in one pass, for constant time lookups by URL or folder name
+    """
+    index: ConfigIndex = {"urls": {}, "folder_names": {}}
+    for category in PACKAGE_CATEGORIES:
+        packages = config["content"][category]
+        index["urls"][category] = {p["url"] for p in packages}
+        index["folder_names"][category] = {package_folder_name(p) for p in packages}
+    return index
+
+
+def update_package_git_repo(package: ConfigPackage, collection_folder: pathlib.Path,
+                            console: rich.console.Console, full_history: bool = False) -> bool:
+    return update_package_git_repo_at(package, collection_folder / package_folder_name(package), console,
+                                      full_history)
+
+
+def run_git(package_folder: Optional[pathlib.Path], *args: str) -> str:
+    """
+    Run a Git command in the given folder (if any) and return its output, raise subprocess.CalledProcessError on
+    failure
+    """
+    folder_args = ["-C", str(package_folder)] if package_folder else []
+    env = {
+        # Don't let Git take optional locks (e.g. index refresh), nothing else works on the collection repositories
+        # meanwhile
+        "GIT_OPTIONAL_LOCKS": "0",
+        **os.environ,
+        # Several Git commands run in parallel under the progress display, they must fail instead of asking for
+        # credentials (e.g. for a deleted or private repository)
+        "GIT_TERMINAL_PROMPT": "0",
+    }
+    return subprocess.run(["git", *folder_args, *args], check=True, capture_output=True, text=True, env=env,
+                          stdin=subprocess.DEVNULL).stdout
+
+
+def update_package_git_repo_at(package: ConfigPackage, package_folder: pathlib.Path,
+                               console: rich.console.Console, full_history: bool = False) -> bool:
+    """
+    Update the Git package stored in the given folder, or clone it if the folder doesn't exist
+
+    The clone strategy only applies to new clones, existing repositories are updated according to whether they are
+    shallow or not. If full_history is True, the package is cloned as if its clone strategy was "full" and shallow
+    repositories are deepened to the full history
+
+    Return True if the package has been cloned or updated
+    """
+    clone_strategy = "full" if full_history else package.get("clone_strategy", "shallow")
+
     try:
-        repo = git.Repo(package_folder)
-        try:
+        if not package_folder.exists():
+            # By default only fetch the latest commit of the tracked branch, partial clones keep the history but only
+            # download the file contents (blobless) or folders too (treeless) when needed
+            clone_options = []
+            if clone_strategy == "shallow":
+                clone_options += ["--depth=1", "--single-branch"]
+            elif clone_strategy == "blobless":
+                clone_options.append("--filter=blob:none")
+            elif clone_strategy == "treeless":
+                clone_options.append("--filter=tree:0")
+            if package.get("git_remote_branch"):
+                clone_options.append(f"--branch={package['git_remote_branch']}")
+
+            run_git(None, "clone", *clone_options, "--", package["url"], str(package_folder))
+            log_package_status(console, CLONED_STATUS, package)
+            return True
+
+        # Git would otherwise look for a repository in the parent folders
+        if not (package_folder / ".git").exists():
+            log_package_status(console, CANT_UPDATE_STATUS, package, ", folder is not a Git repository")
+            return False
+
+        # Get remote default branch name usually "master" or "main" or use configured branch name
+        default_remote_branch = package.get("git_remote_branch")
+        if not default_remote_branch:
             # There are no default remote concept, so we are just assuming the remote to pull from is "origin"
-            remote = repo.remote(ASSUMED_REMOTE_NAME)
+            remote_branches = run_git(package_folder, "for-each-ref", "--format=%(refname:lstrip=3)",
+                                      f"refs/remotes/{ASSUMED_REMOTE_NAME}").split()
+            if not remote_branches:
+                log_package_status(console, CANT_UPDATE_STATUS, package,
+                                   f", remote \"{ASSUMED_REMOTE_NAME}\" do not exist")
+                return False
+            default_remote_branch = remote_branches[0]
+
+        # Repositories cloned before clone strategies existed, or by hand, have the full history
+        is_shallow = run_git(package_folder, "rev-parse", "--is-shallow-repository").strip() == "true"
+
+        # Uncommitted changes, or commits not pushed to the remote, would be lost by a hard reset (untracked files are
+        # left as is)
+        has_local_changes = False
+        if is_shallow and not full_history:
+            uncommitted_changes = run_git(package_folder, "status", "--porcelain",
+                                          "--untracked-files=no").strip()
+            # Remote-tracking branches aren't updated when pulling the remote HEAD, the last fetched commit is known too
+            fetched_refs = ["FETCH_HEAD"] if (package_folder / ".git" / "FETCH_HEAD").is_file() else []
+            unpushed_commits = run_git(package_folder, "rev-list", "--count", "HEAD", "--not",
+                                       f"--remotes={ASSUMED_REMOTE_NAME}", *fetched_refs).strip()
+            has_local_changes = bool(uncommitted_changes) or unpushed_commits != "0"
+
+        if full_history and is_shallow:
+            # Previously cloned as shallow, fetch the missing history too
+            run_git(package_folder, "pull", "--unshallow", ASSUMED_REMOTE_NAME, default_remote_branch)
+        elif is_shallow and not has_local_changes:
+            # Only fetch the latest commit and move to it, the previous history isn't needed
+            run_git(package_folder, "fetch", "--depth=1", ASSUMED_REMOTE_NAME, default_remote_branch)
+            run_git(package_folder, "reset", "--hard", "FETCH_HEAD")
+        else:
+            if has_local_changes:
+                log_package_status(console, KEEPING_CHANGES_STATUS, package, ", pulling instead of resetting")
+
+            # Keep the full history and merge remote changes with local ones
+            run_git(package_folder, "pull", ASSUMED_REMOTE_NAME, default_remote_branch)
+
+        # Update submodules, most packages don't have any
+        if (package_folder / ".gitmodules").is_file():
+            submodule_options = ["--depth=1"] if is_shallow and not full_history else []
+            run_git(package_folder, "submodule", "update", "--init", "--recursive", *submodule_options)
+
+        log_package_status(console, UPDATED_STATUS, package)
+        return True
+
+    except subprocess.CalledProcessError as e:
+        log_package_status(console, CANT_UPDATE_STATUS, package, f", Git command failed: {e.stderr.strip()}")
+
+    return False
+
+
+FETCH_CACHE_FILE_NAME = ".mcm-cache.json"
+
+
+def atomic_write(path: pathlib.Path, data: bytes):
+    """
+    Write data to a temporary file next to the given path, then rename it over the path
 
-            # Fetch remote changes
-            remote.fetch()
+    Readers see either the old or the new content, never a partially written file. The permissions of an existing
+    file are kept.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        # Restrict the permissions before writing anything, a config file may contain private repository URLs
+        tmp_path.touch()
+        if path.exists():
+            shutil.copymode(path, tmp_path)
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def load_fetch_cache(collection_folder: pathlib.Path) -> Dict[str, float]:
+    """
+    Load the time of the last successful update of each package URL stored in the collection folder
+    """
+    try:
+        return orjson.loads((collection_folder / FETCH_CACHE_FILE_NAME).read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
 
-            # Get remote default branch name usually "master" or "main" or use configured branch name
-            default_remote_branch = package.get("git_remote_branch") or remote.refs[0].remote_head
 
-            # Pull remote changes
-            remote.pull(default_remote_branch)
+def save_fetch_cache(collection_folder: pathlib.Path, fetch_cache: Dict[str, float]):
+    """
+    Atomically replace the update times stored in the collection folder
+    """
+    collection_folder.mkdir(parents=True, exist_ok=True)
+    atomic_write(collection_folder / FETCH_CACHE_FILE_NAME, orjson.dumps(fetch_cache))
 
-            # remote_pull_changes = remote.pull(default_remote_branch)
-            # console.log("REMOTE PULL CHANGES:", remote_pull_changes)
-            # console.log("DEFAULT REMOTE BRANCH:", default_remote_branch)
 
-            # Update submodules
-            repo.submodule_update()
+@functools.lru_cache(maxsize=None)
+def get_cdb_session() -> requests.Session:
+    """
+    Return the HTTP session shared by all ContentDB requests, so connections are kept alive and reused
+    """
+    import requests
+    import requests.adapters
 
-            console.log(f"[green]Updated [blue]{package['url']}")
-        except ValueError:
-            console.log(
-                f"[red]Can't update [blue]{package['url']}[red], ",
-                f"[red]remote \"origin\" do not exist")
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    except git.NoSuchPathError:
-        git.Repo.clone_from(package["url"], package_folder)
-        console.log(f"[green]Cloned [blue]{package['url']}")
-    except git.InvalidGitRepositoryError:
-        console.log(
-            f"[red]Can't update [blue]{package['url']}[red], folder is not a "
-            f"Git repository")
-    except git.GitCommandError as e:
-        console.log(
-            f"[red]Can't update [blue]{package['url']}[red], "
-            f"[red]Git command failed: {e.stderr}")
 
+def get_cdb_package_list(url: str) -> Iterator[CDBPackage]:
+    """
+    Yield the packages of a ContentDB instance while the response is being received, so the whole list (several MB)
+    is never held in memory
+    """
+    import ijson
 
-def get_cdb_package_list(url: str) -> List[CDBPackage]:
-    result = urllib.request.urlopen(url + "/api/packages/?type=mod&type=game&type=txp")
-    return result
+    with get_cdb_session().get(url + "/api/packages/", params={"type": ["mod", "game", "txp"]}, timeout=30,
+                               stream=True) as response:
+        response.raise_for_status()
+        # Let urllib3 decompress the raw stream
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "item", use_float=True)
 
 
 def update_package_cdb(package: ConfigPackage, collection_folder: pathlib.Path, console: rich.console.Console):
     pass
 
 
+# Resolved from the script location, so commands work from any working directory
+CONFIG_SCHEMA_PATH = pathlib.Path(__file__).parent / "config_schema.json"
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_validator(schema_path: pathlib.Path = CONFIG_SCHEMA_PATH) -> Callable[[Any], Any]:
+    """
+    Load the config schema and compile it to a validation function, only once per schema file
+
+    The schema is compiled to Python code with fastjsonschema, falling back to the (slower) jsonschema validator if it
+    uses keywords fastjsonschema doesn't support. Validation errors are always raised as
+    fastjsonschema.JsonSchemaValueException
+    """
+    import fastjsonschema
+
+    with open(schema_path, "rb") as config_schema_file:
+        config_schema = orjson.loads(config_schema_file.read())
+
+    try:
+        # Don't fill in default values, the config would be written back with them
+        return fastjsonschema.compile(config_schema, use_default=False)
+    except fastjsonschema.JsonSchemaDefinitionException:
+        import jsonschema
+
+        validator_cls = jsonschema.validators.validator_for(config_schema)
+        validator_cls.check_schema(config_schema)
+        validator = validator_cls(config_schema)
+
+        def validate(config: Any):
+            try:
+                validator.validate(config)
+            except jsonschema.ValidationError as e:
+                raise fastjsonschema.JsonSchemaValueException(e.message) from e
+
+        return validate
+
+
 def get_validated_config(config_file: TextIO, console: rich.console.Console) -> Union[Config, NoReturn]:
     """
     Get validated config from file or crash with output to console
+
+    The hash of the last successfully validated config is stored next to it in a ".validated" file, so validation is
+    skipped as long as neither the config nor the schema change
     """
+    config_text = config_file.read()
 
     config: Config
     try:
-        config = json.load(config_file)
-    except json.JSONDecodeError as e:
+        config = orjson.loads(config_text)
+    except orjson.JSONDecodeError as e:
         console.log("[red] Malformed config file:", e.args[0])
         exit(1)
 
+    # Stdin or other streams without a real file can't have a validation cache
+    config_path = pathlib.Path(config_file.name) if isinstance(config_file.name, str) else None
+    if config_path and config_path.is_file():
+        validated_path = config_path.with_name(config_path.name + ".validated")
+    else:
+        validated_path = None
+
+    with open(CONFIG_SCHEMA_PATH, "rb") as config_schema_file:
+        config_hash = hashlib.sha256(config_schema_file.read() + config_text.encode()).hexdigest()
+
+    try:
+        if validated_path and validated_path.read_text() == config_hash:
+            return config
+    except OSError:
+        pass
+
+    import fastjsonschema
+
     # Validate config file
-    with open("config_schema.json") as config_schema_file:
-        config_schema = json.load(config_schema_file)
-        try:
-            jsonschema.validate(config, config_schema)
-        except jsonschema.ValidationError as e:
-            console.log("[red] Malformed config file:", e.args[0])
-            exit(1)
+    try:
+        get_config_validator()(config)
+    except fastjsonschema.JsonSchemaValueException as e:
+        console.log("[red] Malformed config file:", e.args[0])
+        exit(1)
+
+    try:
+        if validated_path:
+            atomic_write(validated_path, config_hash.encode())
+    except OSError:
+        pass
 
     return config
 
 
+def dump_config(config: Config) -> bytes:
+    """
+    Serialize a config the way config files are written (2 spaces indentation)
+    """
+    return orjson.dumps(config, option=orjson.OPT_INDENT_2)
+
+
+@functools.lru_cache(maxsize=None)
+def get_console() -> rich.console.Console:
+    """
+    Return the console shared by the whole program, so the terminal is only probed once
+
+    Commands get the console once their arguments are parsed, so the Rich traceback handler is installed here rather
+    than for "--help" too
+    """
+    import rich.console
+
+    console = rich.console.Console()
+
+    # Plain Python tracebacks are easier to deal with when the output is processed by scripts
+    if not os.environ.get("MCM_PLAIN_TRACEBACKS"):
+        import rich.traceback
+        rich.traceback.install(console=console, show_locals=False)
+
+    return console
+
+
 # TODO: use dedicated rich-click when availlable
 
 @click.group()
@@ -185,7 +496,6 @@ def cli():
     """
     Minetest Collection Manager
     """
-    pass
 
 
 @cli.command()
@@ -197,45 +507,65 @@ def cli():
 @click.argument("url", type=str)
 @click.option("--folder-name", type=str)
 @click.option("--git-remote-branch", type=str, default=None)
+@click.option("--clone-strategy", type=click.Choice(["full", "shallow", "blobless", "treeless"], case_sensitive=False),
+              default=None, help="How Git packages are cloned [default: shallow]")
 @click.option("--sort", is_flag=True, show_default=True, default=False)
 def add_package(config_file: pathlib.Path, category: PackageCategory, package_type: PackageType, url: str,
-                folder_name: Optional[str], git_remote_branch: Optional[str], sort: bool):
+                folder_name: Optional[str], git_remote_branch: Optional[str], clone_strategy: Optional[CloneStrategy],
+                sort: bool):
     """
     Add package to given config file
     """
     # Load console and config file
-    console = rich.console.Console()
+    console = get_console()
 
     with config_file.open("r") as f:
         config = get_validated_config(f, console)
 
+    index = index_config(config)
+
     # Check if a package with the same url is already present for the category
-    is_url_present = any(p["url"] == url for p in config["content"][category])
-    if is_url_present:
+    if url in index["urls"][category]:
         console.log("[red] Package with same URL already exist for the category")
         exit(1)
 
     # Check if a package with the same folder name is already present for the category
     final_folder_name = folder_name or git_folder_name(url)
-    is_folder_name_present = any(
-        (p.get("folder_name") or git_folder_name(p["url"])) == final_folder_name for p in config["content"][category])
-    if is_folder_name_present:
+    if not folder_name_pattern.fullmatch(final_folder_name):
+        console.log(f"[red] Invalid folder name \"{final_folder_name}\", use --folder-name to choose another one")
+        exit(1)
+
+    if final_folder_name in index["folder_names"][category]:
         console.log("[red] Package with same folder name already exist")
         exit(1)
 
-    config["content"][category].append({
+    # The same package in another category is allowed, but most likely a mistake
+    for other_category in PACKAGE_CATEGORIES:
+        if other_category != category and url in index["urls"][other_category]:
+            console.log(f"[yellow] Package with same URL already exist in category {other_category}")
+
+    new_package: ConfigPackage = {
         "type": package_type,
         "url": url
-    })
+    }
+
+    if folder_name:
+        new_package["folder_name"] = folder_name
 
     if git_remote_branch:
-        config["content"][category][-1]["git_remote_branch"] = git_remote_branch
+        new_package["git_remote_branch"] = git_remote_branch
 
+    if clone_strategy:
+        new_package["clone_strategy"] = clone_strategy
+
+    config["content"][category].append(new_package)
+
+    # The list may not be sorted yet (edited by hand or auto_sort enabled later), sorting an already sorted list with a
+    # single new entry only takes linear time anyway
     if sort or config.get("auto_sort"):
         config["content"][category].sort(key=lambda e: e["url"])
 
-    with config_file.open("w") as f:
-        json.dump(config, f, indent="\t")
+    atomic_write(config_file, dump_config(config))
 
 
 @cli.command()
@@ -250,16 +580,20 @@ def remove_package(config_file: pathlib.Path, category: PackageCategory, package
     Remove package from given config file
     """
     # Load console and config file
-    console = rich.console.Console()
+    console = get_console()
 
     with config_file.open("r") as f:
         config = get_validated_config(f, console)
 
-    config["content"][category] = [d for d in config["content"][category] if
-                                   d.get("url") != url or d.get("type") != package_type]
+    packages = config["content"][category]
+    config["content"][category] = [d for d in packages if d.get("url") != url or d.get("type") != package_type]
+
+    # Leave the config file untouched if there is nothing to remove
+    if len(config["content"][category]) == len(packages):
+        console.log("[yellow] No package with this URL and type in the category")
+        return
 
-    with config_file.open("w") as f:
-        json.dump(config, f, indent="\t")
+    atomic_write(config_file, dump_config(config))
 
 
 @cli.command()
@@ -267,12 +601,21 @@ def remove_package(config_file: pathlib.Path, category: PackageCategory, package
 @click.argument("collection",
                 type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True, resolve_path=True,
                                 allow_dash=False, path_type=pathlib.Path))
-def update(config_file: io.TextIOWrapper, collection: pathlib.Path):
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=None,
+              help="Number of packages to update in parallel [default: min(8, package count)]")
+@click.option("--min-age", type=click.FloatRange(min=0), default=0, show_default=True,
+              help="Skip packages successfully updated less than this number of seconds ago")
+@click.option("--full-history", is_flag=True, show_default=True, default=False,
+              help="Clone and update every Git package with its full history, whatever its clone strategy")
+def update(config_file: io.TextIOWrapper, collection: pathlib.Path, jobs: Optional[int], min_age: float,
+           full_history: bool):
     """
     Update packages in given collection folder using given config file
     """
+    import rich.progress
+
     # Load console and config file
-    console = rich.console.Console()
+    console = get_console()
 
     config = get_validated_config(config_file, console)
 
@@ -282,61 +625,144 @@ def update(config_file: io.TextIOWrapper, collection: pathlib.Path):
     txp_count = len(config["content"]["texture_packs"])
     console.log(f"[green]Updating {mod_count} mods...")
 
+    # Git operations are network bound, so a few packages can be updated at the same time
+    jobs = jobs or max(1, min(8, mod_count + csm_count + game_count + txp_count))
+
     # Determine the collection folder
     collection_folder = collection.absolute()
 
-    with rich.progress.Progress(rich.progress.SpinnerColumn(spinner_name="arrow3"),
-                                rich.progress.TextColumn("[progress.description]{task.description}"),
-                                rich.progress.BarColumn(), rich.progress.MofNCompleteColumn(),
-                                rich.progress.TimeElapsedColumn(),
-                                console=console) as progress:
-        task_mods = progress.add_task(f"[green]Updating mods...", total=mod_count, start=(mod_count == 0))
-        task_client_mods = progress.add_task(f"[green]Updating client mods...", total=csm_count, start=(csm_count == 0))
-        task_games = progress.add_task(f"[green]Updating games...", total=game_count, start=(game_count == 0))
-        task_texturepacks = progress.add_task(f"[green]Updating texture packs...", total=txp_count,
-                                              start=(txp_count == 0))
-
-        if mod_count == 0:
-            progress.stop_task(task_mods)
-        if game_count == 0:
-            progress.stop_task(task_games)
-        if csm_count == 0:
-            progress.stop_task(task_client_mods)
-        if txp_count == 0:
-            progress.stop_task(task_texturepacks)
-
-        def update_packages(task: rich.progress.TaskID, package_category: PackageCategory):
-            progress.start_task(task)
-            for package in config["content"][package_category]:
-
-                if package["type"] == "git":
-                    update_package_git_repo(package, collection_folder / package_category, console)
-                    # time.sleep(1)
-                    progress.update(task, advance=1)
-
-        update_packages(task_mods, "mods")
-        update_packages(task_client_mods, "client_mods")
-        update_packages(task_games, "games")
-        update_packages(task_texturepacks, "texture_packs")
+    # Resolve the folder of every Git package once, before starting any work
+    package_folders = {
+        category: [(package, collection_folder / category / package_folder_name(package))
+                   for package in config["content"][category] if package["type"] == "git"]
+        for category in PACKAGE_CATEGORIES
+    }
+
+    fetch_cache = load_fetch_cache(collection_folder)
+    start_time = time.time()
+
+    try:
+        with rich.progress.Progress(rich.progress.SpinnerColumn(spinner_name="arrow3"),
+                                    rich.progress.TextColumn("[progress.description]{task.description}"),
+                                    rich.progress.BarColumn(), rich.progress.MofNCompleteColumn(),
+                                    rich.progress.TimeElapsedColumn(),
+                                    console=console) as progress, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            task_mods = progress.add_task(f"[green]Updating mods...", total=mod_count, start=(mod_count == 0))
+            task_client_mods = progress.add_task(f"[green]Updating client mods...", total=csm_count,
+                                                 start=(csm_count == 0))
+            task_games = progress.add_task(f"[green]Updating games...", total=game_count, start=(game_count == 0))
+            task_texturepacks = progress.add_task(f"[green]Updating texture packs...", total=txp_count,
+                                                  start=(txp_count == 0))
+
+            if mod_count == 0:
+                progress.stop_task(task_mods)
+            if game_count == 0:
+                progress.stop_task(task_games)
+            if csm_count == 0:
+                progress.stop_task(task_client_mods)
+            if txp_count == 0:
+                progress.stop_task(task_texturepacks)
+
+            category_tasks: Dict[PackageCategory, rich.progress.TaskID] = {
+                "mods": task_mods,
+                "client_mods": task_client_mods,
+                "games": task_games,
+                "texture_packs": task_texturepacks,
+            }
+
+            # Submit the packages of all categories at once, so the workers never wait for a category to be done
+            futures = {}
+            for package_category, task in category_tasks.items():
+                progress.start_task(task)
+                for package, package_folder in package_folders[package_category]:
+                    # Packages whose folder has been deleted or moved meanwhile are cloned again anyway
+                    if start_time - fetch_cache.get(package["url"], 0) < min_age and package_folder.exists():
+                        log_package_status(console, SKIPPED_STATUS, package, " (updated recently)")
+                        progress.update(task, advance=1)
+                    else:
+                        future = executor.submit(update_package_git_repo_at, package, package_folder, console,
+                                                 full_history)
+                        futures[future] = (package, task)
+
+            # Advance the progress bars once per refresh with all packages completed meanwhile, instead of once per
+            # package, so workers finishing together don't each trigger a progress update
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=1 / progress.live.refresh_per_second)
+                advances = collections.Counter()
+                for future in done:
+                    package, task = futures[future]
+                    if future.result():
+                        fetch_cache[package["url"]] = time.time()
+                    advances[task] += 1
+                for task, advance in advances.items():
+                    progress.update(task, advance=advance)
+    finally:
+        save_fetch_cache(collection_folder, fetch_cache)
 
 
 def sync_folders(input_path: pathlib.Path, output_path: pathlib.Path, name: str, console: rich.console.Console):
     """
     Symlink all folders from input path to output path if possible, log results
     """
-    if input_path.exists() and input_path.is_dir():
-        for p in input_path.iterdir():
-            if p.is_dir():
-                if not output_path.exists():
-                    output_path.mkdir()
-                if (output_path / p.name).exists():
-                    if (output_path / p.name).is_symlink() and (output_path / p.name).readlink() == p:
-                        console.log(f"[green] ({name}) [blue]{p.name}[green] is already linked in collection")
-                    else:
-                        console.log(f"[red] ({name}) Cant link [blue]{p.name}[red], folder already exist in collection")
-                else:
-                    (output_path / p.name).symlink_to(p)
-                    console.log(f"[green] ({name}) Linked [blue]{p.name}[green] in collection")
+    # Scan both folders once instead of checking each entry separately, missing folders are handled by the scan itself
+    # rather than checked beforehand
+    try:
+        with os.scandir(input_path) as it:
+            # Symlinks are followed, so that folders linked by sync-dev are synced too
+            input_entries = [entry for entry in it if entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    output_entries: Dict[str, os.DirEntry] = {}
+    try:
+        with os.scandir(output_path) as it:
+            output_entries = {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        pass
+
+    to_link: List[os.DirEntry] = []
+    already_linked: List[os.DirEntry] = []
+    conflicting: List[os.DirEntry] = []
+
+    for entry in input_entries:
+        existing = output_entries.get(entry.name)
+        if existing is None:
+            to_link.append(entry)
+        elif existing.is_symlink() and os.readlink(existing.path) == entry.path:
+            already_linked.append(entry)
+        else:
+            conflicting.append(entry)
+
+    if input_entries:
+        output_path.mkdir(exist_ok=True)
+
+    # Where supported (symlinkat), create links relative to an open handle of the output folder, so the kernel doesn't
+    # have to resolve the whole output path again for every link
+    output_fd = None
+    if to_link and os.symlink in os.supports_dir_fd:
+        output_fd = os.open(output_path, os.O_RDONLY)
+
+    try:
+        # Symlink creation is a syscall per folder, create them in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            output_dir = os.fspath(output_path)
+            futures = [executor.submit(os.symlink, entry.path,
+                                       entry.name if output_fd is not None else os.path.join(output_dir, entry.name),
+                                       dir_fd=output_fd)
+                       for entry in to_link]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+    finally:
+        if output_fd is not None:
+            os.close(output_fd)
+
+    for entry in conflicting:
+        console.log(f"[red] ({name}) Cant link [blue]{entry.name}[red], folder already exist in collection")
+
+    console.log(f"[green] ({name}) Linked {len(to_link)} folders in collection, "
+                f"{len(already_linked)} already linked, {len(conflicting)} conflicts")
 
 
 @cli.command()
@@ -351,7 +777,7 @@ def sync_dev(collection: pathlib.Path, dev_directory: pathlib.Path):
     Sync a development folder with a collection folder by symlinking all folders if possible
     """
     # Load console
-    console = rich.console.Console()
+    console = get_console()
 
     for cat in zip(["mods", "client_mods", "games", "texture_packs"], ["mods", "clientmods", "games", "textures"]):
         sync_folders(dev_directory / cat[0], collection / cat[0], cat[0], console)
@@ -369,21 +795,23 @@ def sync(collection: pathlib.Path, user_directory: pathlib.Path):
     Sync a collection folder with a Minetest user directory
     """
     # Load console
-    console = rich.console.Console()
+    console = get_console()
     for cat in zip(["mods", "client_mods", "games", "texture_packs"], ["mods", "clientmods", "games", "textures"]):
         sync_folders(collection / cat[0], user_directory / cat[1], cat[0], console)
 
 
 @cli.command()
-@click.argument("config_file", type=click.File("w+"))
+@click.argument("config_file",
+                type=click.Path(file_okay=True, dir_okay=False, writable=True, resolve_path=True, allow_dash=True,
+                                path_type=pathlib.Path))
 @click.option("--schema", is_flag=True, default=False)
 @click.option("--auto-sort", is_flag=True, default=False)
-def create_config(config_file: io.TextIOWrapper, schema: bool, auto_sort: bool):
+def create_config(config_file: pathlib.Path, schema: bool, auto_sort: bool):
     # Load console
-    console = rich.console.Console()
+    console = get_console()
 
-    json.dump({
-        "$schema": schema and str(pathlib.Path(__file__).parent / "config_schema.json") or None,
+    config = dump_config({
+        "$schema": schema and str(CONFIG_SCHEMA_PATH) or None,
         "content": {
             "mods": [],
             "client_mods": [],
@@ -391,7 +819,12 @@ def create_config(config_file: io.TextIOWrapper, schema: bool, auto_sort: bool):
             "texture_packs": []
         },
         "auto_sort": auto_sort
-    }, config_file, indent="\t")
+    })
+
+    if str(config_file) == "-":
+        click.get_binary_stream("stdout").write(config)
+    else:
+        atomic_write(config_file, config)
 
     console.log(f"[green] Config file created (schema={schema}, auto_sort={auto_sort})")
 